@@ -1,47 +1,62 @@
 import os
-import openai
 import json
 
-# Load from environment (Railway → Variables)
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+from openai import AsyncOpenAI
 
-openai.api_key = OPENAI_API_KEY
+from worker.http_client import get_async_client
+from worker.limits import openai_semaphore, openai_limiter, call_with_retries
 
+_client: AsyncOpenAI | None = None
 
-class CaptionGenerator:
-    async def generate_captions(self, image_url: str) -> list[str]:
-        """Generate AI captions using GPT-4o Vision."""
-        try:
-            # Step 1: Describe the image using GPT-4o Vision
-            description = await self.describe_image(image_url)
 
-            # Step 2: Ask GPT-4o to write 5 captions
-            prompt = f"""
-Based on this image description: "{description}"
+def _openai() -> AsyncOpenAI:
+    """Lazy module-level client so all calls share one HTTP pool."""
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=get_async_client(),
+        )
+    return _client
+
 
-Generate 5 creative, engaging social media captions.
+class CaptionGenerator:
+    async def generate_captions(self, image_url: str) -> list[str]:
+        """Generate AI captions using GPT-4o Vision in one round trip."""
+        prompt = """
+Look at this image and generate 5 creative, engaging social media captions.
 Requirements:
 - Use emojis
 - Keep under 150 characters
 - Make it aesthetic, trendy, and viral-ready
 - Add relevant hashtags
-- Return output ONLY as a JSON array of strings
-            """
+- Return ONLY a JSON object of the form {"captions": ["...", ...]}
+        """
 
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are a creative social media caption expert."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.9,
-                max_tokens=500,
-            )
+        async def _request():
+            async with openai_semaphore, openai_limiter:
+                return await _openai().chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {"role": "system", "content": "You are a creative social media caption expert."},
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": prompt},
+                                {"type": "image_url", "image_url": {"url": image_url}}
+                            ]
+                        }
+                    ],
+                    response_format={"type": "json_object"},
+                    temperature=0.9,
+                    max_tokens=500,
+                )
 
-            raw = response.choices[0].message["content"]
+        try:
+            response = await call_with_retries(_request)
 
-            # Parse JSON array
-            captions = json.loads(raw)
+            raw = response.choices[0].message.content
+            captions = json.loads(raw)["captions"]
 
             return captions
 
@@ -54,27 +69,3 @@ Requirements:
                 "🌟 Pure mood",
                 "📸 Vibes only"
             ]
-
-
-    async def describe_image(self, image_url: str) -> str:
-        """Use GPT-4o Vision to describe the image."""
-        try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Describe this image clearly for caption generation."},
-                            {"type": "image_url", "image_url": {"url": image_url}}
-                        ]
-                    }
-                ],
-                max_tokens=300
-            )
-
-            return response.choices[0].message["content"]
-
-        except Exception as e:
-            print("Vision error:", str(e))
-            return "A beautifully captured moment"
@@ -0,0 +1,256 @@
+import asyncio
+import os
+import numpy as np
+from PIL import Image
+
+# Local inference is optional: CPU-only deploys skip these packages and
+# the enhancers fall back to Replicate / PIL.
+try:
+    import torch
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    from realesrgan import RealESRGANer
+except ImportError:
+    torch = None
+    RRDBNet = None
+    RealESRGANer = None
+
+# Optional TensorRT path for the INT8 engine
+try:
+    from torch2trt import torch2trt
+except ImportError:
+    torch2trt = None
+
+_MODEL_PATH = os.getenv(
+    "REALESRGAN_MODEL_PATH",
+    os.path.join(os.path.dirname(__file__), "weights", "RealESRGAN_x2plus.pth"),
+)
+
+_CALIB_DIR = os.getenv("REALESRGAN_CALIB_DIR")
+
+
+def _load_rgb(input_path: str) -> np.ndarray:
+    return np.asarray(Image.open(input_path).convert("RGB"))
+
+
+def _save(img: Image.Image, output_path: str):
+    """Lossless fast PNG for intermediates, quality-95 JPEG otherwise."""
+    if output_path.lower().endswith(".png"):
+        img.save(output_path, compress_level=1)
+    else:
+        img.save(output_path, quality=95)
+
+# One engine per precision ("fp16", "int8"), each loaded once per process
+_upsamplers: dict = {}
+
+
+def available() -> bool:
+    # CPU inference of a tiled RRDBNet is minutes per photo — slower
+    # than the Replicate path — so CPU-only hosts report unavailable
+    return (
+        RealESRGANer is not None
+        and torch.cuda.is_available()
+        and os.path.exists(_MODEL_PATH)
+    )
+
+
+def get_upsampler(precision: str = "fp16") -> "RealESRGANer | None":
+    """Warm module-level Real-ESRGAN x2 upsampler, loaded once per process.
+
+    Runs fp16 on CUDA (with cuDNN autotune enabled for fixed-size tiles)
+    and fp32 on CPU. precision="int8" additionally converts the network
+    to a calibrated TensorRT INT8 engine when torch2trt is installed;
+    otherwise it quietly serves the fp16 engine.
+    """
+    if not available():
+        return None
+    if precision != "int8":
+        precision = "fp16"
+    # INT8 needs torch2trt plus either a real calibration set or an
+    # already-built engine; calibrating on anything else (e.g. noise)
+    # produces garbage activation ranges, so downgrade to fp16 instead
+    if precision == "int8" and (
+        torch2trt is None
+        or not torch.cuda.is_available()
+        or not (_has_calibration_set()
+                or os.path.exists(_MODEL_PATH + ".int8.trt"))
+    ):
+        precision = "fp16"
+
+    if precision not in _upsamplers:
+        use_cuda = torch.cuda.is_available()
+        if use_cuda:
+            torch.backends.cudnn.benchmark = True
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64,
+                        num_block=23, num_grow_ch=32, scale=2)
+        upsampler = RealESRGANer(
+            scale=2,
+            model_path=_MODEL_PATH,
+            model=model,
+            tile=400,
+            tile_pad=10,
+            pre_pad=0,
+            half=use_cuda,
+        )
+        if precision == "int8":
+            upsampler.model = _int8_engine(upsampler.model)
+        _upsamplers[precision] = upsampler
+    return _upsamplers[precision]
+
+
+def _int8_engine(model):
+    """Build (or load a cached) calibrated TensorRT INT8 engine."""
+    from torch2trt import TRTModule
+
+    engine_path = _MODEL_PATH + ".int8.trt"
+    if os.path.exists(engine_path):
+        trt_model = TRTModule()
+        trt_model.load_state_dict(torch.load(engine_path))
+        return trt_model
+
+    # RealESRGANer(tile=400, tile_pad=10) feeds the model padded tiles
+    # up to 420x420 plus smaller edge tiles, so the engine must accept
+    # a shape range — a fixed-size trace would reject every tile
+    sample = torch.randn(1, 3, 420, 420).cuda().half()
+    trt_model = torch2trt(
+        model, [sample],
+        fp16_mode=True,
+        int8_mode=True,
+        int8_calib_dataset=_calibration_images(),
+        min_shapes=[(1, 3, 32, 32)],
+        opt_shapes=[(1, 3, 420, 420)],
+        max_shapes=[(1, 3, 420, 420)],
+    )
+    # Smoke-test an edge-tile shape before caching the engine to disk
+    with torch.no_grad():
+        trt_model(torch.randn(1, 3, 220, 420).cuda().half())
+    torch.save(trt_model.state_dict(), engine_path)
+    return trt_model
+
+
+def _has_calibration_set() -> bool:
+    return bool(_CALIB_DIR and os.path.isdir(_CALIB_DIR) and os.listdir(_CALIB_DIR))
+
+
+def _calibration_images(limit: int = 100) -> list:
+    """Representative tiles for INT8 calibration, at the opt shape."""
+    images = []
+    for name in sorted(os.listdir(_CALIB_DIR))[:limit]:
+        img = Image.open(os.path.join(_CALIB_DIR, name)).convert("RGB")
+        img = img.resize((420, 420))
+        tensor = torch.from_numpy(np.asarray(img)).permute(2, 0, 1)
+        images.append([tensor.float().div_(255).unsqueeze(0).cuda().half()])
+    return images
+
+
+def enhance(input_path: str, output_path: str, precision: str = "fp16",
+            img: "np.ndarray | None" = None):
+    """Upscale 2x locally; raises RuntimeError if the model is unavailable.
+
+    Accepts an already-decoded RGB array so callers that had to decode
+    anyway (the batcher's size check) don't pay a second decode.
+    """
+    upsampler = get_upsampler(precision)
+    if upsampler is None:
+        raise RuntimeError("local Real-ESRGAN model not available")
+
+    if img is None:
+        img = _load_rgb(input_path)
+    # RealESRGANer expects BGR channel order (cv2 convention)
+    out, _ = upsampler.enhance(img[..., ::-1], outscale=2)
+    _save(Image.fromarray(out[..., ::-1]), output_path)
+
+
+# --- dynamic micro-batching -------------------------------------------------
+#
+# Concurrent photo jobs are collected into one NCHW forward pass instead of
+# N sequential ones, which keeps tensor cores fed. Images too large for an
+# untiled pass take the tiled single-image path above.
+
+_BATCH_SIZE = 8
+_BATCH_MAX_DELAY = 0.05  # seconds to wait for more work before flushing
+_BATCH_MAX_PIXELS = 2_000_000  # larger inputs need RealESRGANer's tiling
+
+_batch_queue: asyncio.Queue | None = None
+_batch_task: asyncio.Task | None = None
+
+
+async def enhance_batched(input_path: str, output_path: str, precision: str = "fp16"):
+    """Queue an image for the next batched forward pass and await it.
+
+    The batcher always runs the fp16 engine; int8 jobs take the tiled
+    single-image path so engines never mix within a batch.
+    """
+    # First call pays the multi-second weights load, and the decode is a
+    # full-resolution JPEG/PNG pass — both belong off the event loop
+    if await asyncio.to_thread(get_upsampler, precision) is None:
+        raise RuntimeError("local Real-ESRGAN model not available")
+
+    img = await asyncio.to_thread(_load_rgb, input_path)
+    if precision == "int8" or img.shape[0] * img.shape[1] > _BATCH_MAX_PIXELS:
+        await asyncio.to_thread(enhance, input_path, output_path, precision, img)
+        return
+
+    global _batch_queue, _batch_task
+    loop = asyncio.get_running_loop()
+    if _batch_queue is None:
+        _batch_queue = asyncio.Queue()
+    if _batch_task is None or _batch_task.done():
+        _batch_task = loop.create_task(_batch_loop())
+
+    future = loop.create_future()
+    await _batch_queue.put((img, future))
+    out = await future
+    await asyncio.to_thread(_save, Image.fromarray(out), output_path)
+
+
+async def _batch_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = loop.time() + _BATCH_MAX_DELAY
+        while len(batch) < _BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # One forward pass per distinct shape (tensors must stack)
+        by_shape: dict = {}
+        for img, future in batch:
+            by_shape.setdefault(img.shape, []).append((img, future))
+
+        for items in by_shape.values():
+            try:
+                outs = await asyncio.to_thread(
+                    _forward_batch, [img for img, _ in items]
+                )
+                for (_, future), out in zip(items, outs):
+                    if not future.done():
+                        future.set_result(out)
+            except Exception as exc:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(exc)
+
+
+def _forward_batch(imgs: list) -> list:
+    upsampler = get_upsampler()
+    tensor = torch.from_numpy(np.stack(imgs)).permute(0, 3, 1, 2).float().div_(255)
+    tensor = tensor.to(upsampler.device)
+    if upsampler.half:
+        tensor = tensor.half()
+    # RRDBNet at scale=2 pixel-unshuffles its input, so odd dimensions
+    # need the same mod-2 padding RealESRGANer.pre_process applies;
+    # crop the 2x output back afterwards
+    h, w = tensor.shape[2], tensor.shape[3]
+    if h % 2 or w % 2:
+        tensor = torch.nn.functional.pad(
+            tensor, (0, w % 2, 0, h % 2), mode='reflect')
+    with torch.no_grad():
+        out = upsampler.model(tensor)
+    out = out[:, :, :2 * h, :2 * w]
+    out = out.clamp_(0, 1).mul_(255).round_().byte()
+    return list(out.permute(0, 2, 3, 1).cpu().numpy())
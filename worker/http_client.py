@@ -0,0 +1,37 @@
+import httpx
+
+# Optional aiohttp-backed transport: httpx's default anyio backend
+# degrades badly at high concurrency, aiohttp does not.
+try:
+    import aiohttp
+    from httpx_aiohttp import AiohttpTransport
+except ImportError:
+    aiohttp = None
+    AiohttpTransport = None
+
+_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+_TIMEOUT = httpx.Timeout(10.0, read=300.0)
+
+_client: httpx.AsyncClient | None = None
+
+
+def _build_transport():
+    if AiohttpTransport is None:
+        return None
+    return AiohttpTransport(client=aiohttp.ClientSession())
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Shared AsyncClient for the whole worker process.
+
+    One client keeps connection pools and TLS sessions warm across jobs;
+    callers must not close it.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            transport=_build_transport(),
+            limits=_LIMITS,
+            timeout=_TIMEOUT,
+        )
+    return _client
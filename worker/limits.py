@@ -0,0 +1,57 @@
+import asyncio
+import contextlib
+
+import httpx
+
+try:
+    from aiolimiter import AsyncLimiter
+except ImportError:
+    AsyncLimiter = None
+
+# Bounded fan-out to external providers: without this, a burst of
+# /process jobs fires every OpenAI/Replicate call at once and trips
+# provider rate limits.
+openai_semaphore = asyncio.Semaphore(32)
+replicate_semaphore = asyncio.Semaphore(8)
+
+# Token buckets (requests per minute); no-ops if aiolimiter is absent.
+if AsyncLimiter is not None:
+    openai_limiter = AsyncLimiter(max_rate=90, time_period=60)
+    replicate_limiter = AsyncLimiter(max_rate=30, time_period=60)
+else:
+    openai_limiter = contextlib.nullcontext()
+    replicate_limiter = contextlib.nullcontext()
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Only rate limits, transient 5xxs and network timeouts deserve a
+    retry; a 401/400 will fail identically on every attempt while
+    holding a semaphore and limiter slot."""
+    # openai.APIStatusError exposes status_code directly,
+    # httpx.HTTPStatusError via .response
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(
+        exc, (httpx.TimeoutException, httpx.TransportError,
+              TimeoutError, ConnectionError)
+    )
+
+
+async def call_with_retries(fn, *args, attempts: int = 3, base_delay: float = 1.0):
+    """Await fn(*args), retrying with exponential backoff.
+
+    Retries provider 429s, transient 5xxs and timeouts; permanent
+    failures (bad key, invalid input) raise immediately.
+    """
+    for attempt in range(attempts):
+        try:
+            return await fn(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            if attempt == attempts - 1 or not _is_retryable(exc):
+                raise
+            await asyncio.sleep(base_delay * 2 ** attempt)
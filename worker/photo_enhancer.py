@@ -1,51 +1,94 @@
+import aiofiles
+import asyncio
 import os
 import uuid
-from pathlib import Path
 import tempfile
+import numpy as np
 import replicate
-import requests
-from PIL import Image, ImageEnhance, ImageFilter
-from supabase import create_client
+from PIL import Image
 
+# libvips streams tiles with SIMD convolution instead of decoding the
+# whole source image; optional, PIL is the fallback. The pip package
+# raises OSError (not ImportError) when libvips.so itself is missing.
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
 
-class PhotoEnhancer:
-    def __init__(self):
-        # Load from environment variables in Railway Worker
-        SUPABASE_URL = os.getenv("SUPABASE_URL")
-        SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+from worker import esrgan, storage
+from worker.http_client import get_async_client
+from worker.limits import replicate_semaphore, replicate_limiter, call_with_retries
 
-        if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
-            raise ValueError("Supabase environment variables are missing in worker")
 
-        self.supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-    
-    async def enhance_photo(self, photo_path: str, user_id: str) -> dict:
+def _gaussian_kernel1d(sigma: float) -> np.ndarray:
+    radius = max(1, int(3.0 * sigma + 0.5))
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    k = np.exp(-0.5 * (x / sigma) ** 2)
+    return k / k.sum()
+
+
+def _gaussian_blur(arr: np.ndarray, sigma: float) -> np.ndarray:
+    """Separable Gaussian: one 1D pass per axis instead of a 2D kernel.
+
+    O(2k) work per pixel instead of O(k^2), and each pass is a plain
+    weighted sum of shifted slices, which NumPy vectorizes.
+    """
+    k = _gaussian_kernel1d(sigma)
+    r = len(k) // 2
+    for axis in (0, 1):
+        pad_width = [(0, 0)] * arr.ndim
+        pad_width[axis] = (r, r)
+        pad = np.pad(arr, pad_width, mode="edge")
+        out = np.zeros_like(arr)
+        index = [slice(None)] * arr.ndim
+        for i, w in enumerate(k):
+            index[axis] = slice(i, i + arr.shape[axis])
+            out += w * pad[tuple(index)]
+        arr = out
+    return arr
+
+
+def _smooth3(arr: np.ndarray) -> np.ndarray:
+    """3x3 smoothing kernel (PIL's SMOOTH) applied via shifted slices."""
+    pad = np.pad(arr, ((1, 1), (1, 1), (0, 0)), mode="edge")
+    return (pad[:-2, :-2] + pad[:-2, 1:-1] + pad[:-2, 2:]
+            + pad[1:-1, :-2] + pad[1:-1, 1:-1] * 5 + pad[1:-1, 2:]
+            + pad[2:, :-2] + pad[2:, 1:-1] + pad[2:, 2:]) / 13.0
+
+
+class PhotoEnhancer:
+    # Uploads go through worker.storage over the shared async client,
+    # so this class no longer needs its own supabase client
+
+    async def enhance_photo(self, photo_path: str, user_id: str,
+                            quality: str = "standard") -> dict:
         """Complete photo enhancement pipeline"""
         temp_dir = tempfile.gettempdir()
         output_id = str(uuid.uuid4())
-        
-        # Step 1: AI upscaling & face enhancement
-        enhanced = os.path.join(temp_dir, f"{output_id}_enhanced.jpg")
-        await self.ai_enhance(photo_path, enhanced)
-        
-        # Step 2: Color correction
-        corrected = os.path.join(temp_dir, f"{output_id}_corrected.jpg")
-        await self.color_correct(enhanced, corrected)
-        
-        # Step 3: Aesthetic filters
+
+        # Step 1: AI upscaling & face enhancement (file-based AI boundary).
+        # PNG intermediate: fast to encode at compress_level=1 and avoids
+        # a lossy JPEG generation before the color stages re-decode it.
+        enhanced = os.path.join(temp_dir, f"{output_id}_enhanced.png")
+        await self.ai_enhance(photo_path, enhanced, quality)
+
+        # Steps 2-4: color correction, filters and thumbnail — seconds of
+        # synchronous NumPy/PIL work on a 4K photo, so the whole
+        # decode-through-save section runs in a worker thread
         filtered = os.path.join(temp_dir, f"{output_id}_filtered.jpg")
-        await self.apply_filters(corrected, filtered)
-        
-        # Step 4: Thumbnail
         thumbnail = os.path.join(temp_dir, f"{output_id}_thumb.jpg")
-        await self.generate_thumbnail(filtered, thumbnail)
-        
-        # Step 5: Upload to Supabase
-        media_url = await self.upload_to_storage(filtered, user_id, bucket="processed_media")
-        thumbnail_url = await self.upload_to_storage(thumbnail, user_id, bucket="thumbnails")
-        
+        await asyncio.to_thread(self._filter_and_save, enhanced, filtered, thumbnail)
+
+        # Step 5: Upload both files to Supabase concurrently
+        media_url, thumbnail_url = await asyncio.gather(
+            self.upload_to_storage(filtered, f"{user_id}/{output_id}_media.jpg",
+                                   bucket="processed_media"),
+            self.upload_to_storage(thumbnail, f"{user_id}/{output_id}_thumb.jpg",
+                                   bucket="thumbnails"),
+        )
+
         # Cleanup
-        for f in [enhanced, corrected, filtered, thumbnail]:
+        for f in [enhanced, filtered, thumbnail]:
             if os.path.exists(f):
                 os.remove(f)
         
@@ -56,52 +99,124 @@ class PhotoEnhancer:
             "ai_style": "enhanced"
         }
     
-    async def ai_enhance(self, input_path: str, output_path: str):
-        """AI upscaling using Real-ESRGAN on Replicate"""
+    def _filter_and_save(self, enhanced: str, filtered: str, thumbnail: str):
+        """Decode once, chain the filter stages in memory, save + thumbnail.
+
+        The image is only JPEG-encoded once at the end instead of after
+        every stage.
+        """
+        img = Image.open(enhanced).convert("RGB")
+        img = self.color_correct(img)
+        img = self.apply_filters(img)
+        img.save(filtered, "JPEG", quality=95, optimize=True)
+        self.generate_thumbnail(filtered, thumbnail, img=img)
+
+    async def ai_enhance(self, input_path: str, output_path: str,
+                         quality: str = "standard"):
+        """AI upscaling with Real-ESRGAN: local model first, Replicate second."""
+        if esrgan.available():
+            # Warm in-process model; concurrent jobs share batched
+            # forward passes. Any local inference failure (CUDA OOM,
+            # corrupt weights) falls through to Replicate below.
+            precision = "int8" if quality == "fast" else "fp16"
+            try:
+                await esrgan.enhance_batched(input_path, output_path, precision)
+                return
+            except Exception:
+                pass
+
         try:
-            with open(input_path, "rb") as f:
-                output = replicate.run(
-                    "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b",
-                    input={"image": f, "scale": 2, "face_enhance": True}
+            async with replicate_semaphore, replicate_limiter:
+                output = await call_with_retries(
+                    asyncio.to_thread, self._replicate_enhance, input_path
                 )
 
-            res = requests.get(output)
-            with open(output_path, "wb") as f:
-                f.write(res.content)
+            client = get_async_client()
+            async with client.stream("GET", str(output)) as resp:
+                resp.raise_for_status()
+                async with aiofiles.open(output_path, "wb") as f:
+                    async for chunk in resp.aiter_bytes(1 << 20):
+                        await f.write(chunk)
 
         except Exception:
             # PIL fallback
             img = Image.open(input_path)
             img = img.resize((img.width * 2, img.height * 2), Image.LANCZOS)
-            img.save(output_path, quality=95)
-    
-    async def color_correct(self, input_path: str, output_path: str):
-        img = Image.open(input_path)
-        
-        img = ImageEnhance.Contrast(img).enhance(1.3)
-        img = ImageEnhance.Color(img).enhance(1.2)
-        img = ImageEnhance.Brightness(img).enhance(1.1)
-        img = ImageEnhance.Sharpness(img).enhance(1.5)
-        
-        img.save(output_path, quality=95)
-    
-    async def apply_filters(self, input_path: str, output_path: str):
-        img = Image.open(input_path)
-        
-        img = img.filter(ImageFilter.GaussianBlur(radius=0.5))
-        img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
-        
-        img.save(output_path, quality=95)
-    
-    async def generate_thumbnail(self, photo_path: str, output_path: str):
-        img = Image.open(photo_path)
-        img.thumbnail((400, 400))
-        img.save(output_path, quality=85)
+            if output_path.lower().endswith(".png"):
+                img.save(output_path, compress_level=1)
+            else:
+                img.save(output_path, quality=95)
+
+    def _replicate_enhance(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            return replicate.run(
+                "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b",
+                input={"image": f, "scale": 2, "face_enhance": True}
+            )
     
-    async def upload_to_storage(self, file_path: str, user_id: str, bucket: str) -> str:
-        filename = f"{user_id}/{uuid.uuid4()}.jpg"
+    def color_correct(self, img: Image.Image) -> Image.Image:
+        """Contrast, saturation, brightness and sharpness in one fused pass.
+
+        Equivalent to chaining four ImageEnhance objects, but works on a
+        single float32 array instead of four full-image read/blend/write
+        cycles, so pixel memory is only traversed once.
+        """
+        arr = np.asarray(img, dtype=np.float32)
+
+        # Contrast 1.3 around the mean luminance
+        lum = arr[..., 0] * 0.299 + arr[..., 1] * 0.587 + arr[..., 2] * 0.114
+        arr = (arr - lum.mean()) * 1.3 + lum.mean()
+
+        # Saturation 1.2: push away from the per-pixel grayscale value
+        gray = (arr[..., 0] * 0.299 + arr[..., 1] * 0.587 + arr[..., 2] * 0.114)[..., None]
+        arr = gray + (arr - gray) * 1.2
+
+        # Brightness 1.1
+        arr *= 1.1
 
-        with open(file_path, "rb") as f:
-            self.supabase.storage.from_(bucket).upload(filename, f)
+        # Sharpness 1.5: unsharp against a 3x3 smoothing kernel
+        smooth = _smooth3(arr)
+        arr = smooth + (arr - smooth) * 1.5
 
-        return self.supabase.storage.from_(bucket).get_public_url(filename)
+        out = np.clip(arr, 0, 255).astype(np.uint8)
+        return Image.fromarray(out)
+
+    def apply_filters(self, img: Image.Image) -> Image.Image:
+        """Soft blur + unsharp mask as two separable Gaussians and one
+        fused sharpening expression (amount 1.5, threshold 3), replacing
+        PIL's full 2D GaussianBlur + UnsharpMask convolutions.
+        """
+        arr = np.asarray(img, dtype=np.float32)
+        soft = _gaussian_blur(arr, 0.5)
+        blurred = _gaussian_blur(soft, 2.0)
+        diff = soft - blurred
+        sharp = np.where(np.abs(diff) >= 3, soft + 1.5 * diff, soft)
+        return Image.fromarray(np.clip(sharp, 0, 255).astype(np.uint8))
+
+    def generate_thumbnail(self, source_path: str, output_path: str,
+                           img: Image.Image | None = None):
+        """Write a 400px thumbnail, via libvips when it is installed.
+
+        vips streams the source file tile-by-tile (shrink-on-load, never
+        materializing the full-resolution image); otherwise the
+        already-decoded PIL image is downscaled in memory.
+        """
+        if pyvips is not None:
+            pyvips.Image.thumbnail(
+                source_path, 400, height=400, size="down"
+            ).jpegsave(output_path, Q=85, strip=True)
+            return
+
+        if img is None:
+            img = Image.open(source_path)
+            # draft delegates to libjpeg-turbo's DCT-domain scaling: the
+            # decoder skips coefficients and emits a 1/2..1/8 size image
+            # directly instead of decoding full resolution
+            img.draft("RGB", (800, 800))
+            img.load()
+        thumb = img.copy()
+        thumb.thumbnail((400, 400))
+        thumb.save(output_path, quality=85)
+    
+    async def upload_to_storage(self, file_path: str, object_path: str, bucket: str) -> str:
+        return await storage.upload(file_path, object_path, bucket)
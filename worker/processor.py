@@ -1,21 +1,67 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import httpx
+import aiofiles
+import asyncio
 import os
+import shutil
 import uuid
+from functools import lru_cache
 from pathlib import Path
 import tempfile
 
+
+def _configure_tmpdir(min_free_bytes: int = 1 << 30):
+    """Point temp files at tmpfs so intermediates never hit block I/O.
+
+    /tmp is disk-backed on most containers; /dev/shm is RAM. Only
+    switches when /dev/shm is writable with at least 1 GiB free, and
+    respects an explicit TMPDIR.
+    """
+    shm = "/dev/shm"
+    if "TMPDIR" in os.environ or not os.access(shm, os.W_OK):
+        return
+    try:
+        if shutil.disk_usage(shm).free < min_free_bytes:
+            return
+    except OSError:
+        return
+    os.environ["TMPDIR"] = shm
+    tempfile.tempdir = None  # force re-resolution
+
+
+_configure_tmpdir()
+
 from worker.video_enhancer import VideoEnhancer
 from worker.photo_enhancer import PhotoEnhancer
 from worker.ai_caption import CaptionGenerator
+from worker.http_client import get_async_client
 
 app = FastAPI(title="VIVIA AI Worker")
 
+
+# Singletons: constructing an enhancer builds a fresh Supabase client
+# (and its HTTP session) each time, which is pure per-request overhead
+@lru_cache(maxsize=1)
+def get_video_enhancer() -> VideoEnhancer:
+    return VideoEnhancer()
+
+
+@lru_cache(maxsize=1)
+def get_photo_enhancer() -> PhotoEnhancer:
+    return PhotoEnhancer()
+
+
+@lru_cache(maxsize=1)
+def get_caption_generator() -> CaptionGenerator:
+    return CaptionGenerator()
+
 class ProcessRequest(BaseModel):
     job_id: str
     media_url: str
     user_id: str
+    # "standard" keeps full fidelity; "fast" picks the quantized AI
+    # engine when one is available
+    quality: str = "standard"
 
 class ProcessResult(BaseModel):
     media_url: str
@@ -33,12 +79,17 @@ async def process_media(request: ProcessRequest):
         media_type = detect_media_type(media_path)
 
         if media_type == "video":
-            result = await process_video(media_path, request.user_id)
+            enhance = process_video(media_path, request.user_id)
         else:
-            result = await process_photo(media_path, request.user_id)
+            enhance = process_photo(media_path, request.user_id, request.quality)
 
-        caption_gen = CaptionGenerator()
-        captions = await caption_gen.generate_captions(result["media_url"])
+        # Captions describe the content, not the post-processing, so the
+        # GPT-4o round trip runs on the source URL concurrently with the
+        # enhancement pipeline instead of after it
+        result, captions = await asyncio.gather(
+            enhance,
+            get_caption_generator().generate_captions(request.media_url),
+        )
 
         result["caption"] = captions[0] if captions else ""
         result["captions"] = captions
@@ -56,11 +107,14 @@ async def download_media(url: str) -> str:
     filename = f"{uuid.uuid4()}{Path(url).suffix}"
     filepath = os.path.join(tmp, filename)
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url)
+    # Stream to disk in 64 KiB chunks so memory stays constant no matter
+    # how large the upload is
+    client = get_async_client()
+    async with client.stream("GET", url) as resp:
         resp.raise_for_status()
-        with open(filepath, "wb") as f:
-            f.write(resp.content)
+        async with aiofiles.open(filepath, "wb") as f:
+            async for chunk in resp.aiter_bytes(65536):
+                await f.write(chunk)
 
     return filepath
 
@@ -71,8 +125,8 @@ def detect_media_type(path: str) -> str:
 
 
 async def process_video(path: str, user_id: str):
-    return await VideoEnhancer().enhance_video(path, user_id)
+    return await get_video_enhancer().enhance_video(path, user_id)
 
 
-async def process_photo(path: str, user_id: str):
-    return await PhotoEnhancer().enhance_photo(path, user_id)
+async def process_photo(path: str, user_id: str, quality: str = "standard"):
+    return await get_photo_enhancer().enhance_photo(path, user_id, quality)
@@ -0,0 +1,59 @@
+import os
+from functools import lru_cache
+
+import aiofiles
+
+from worker.http_client import get_async_client
+
+_CHUNK_SIZE = 1 << 20
+
+
+@lru_cache(maxsize=1)
+def _config() -> tuple:
+    """Base URL and auth header, resolved once per process."""
+    base_url = os.getenv("SUPABASE_URL")
+    service_key = os.getenv("SUPABASE_SERVICE_KEY")
+    if not base_url or not service_key:
+        raise ValueError("Supabase environment variables are missing in worker")
+    return base_url, {"Authorization": f"Bearer {service_key}"}
+
+_CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "mp4": "video/mp4",
+}
+
+
+async def _file_chunks(file_path: str):
+    async with aiofiles.open(file_path, "rb") as f:
+        while chunk := await f.read(_CHUNK_SIZE):
+            yield chunk
+
+
+async def upload(file_path: str, object_path: str, bucket: str) -> str:
+    """Upload a file to Supabase storage over the shared async client.
+
+    Streams the body in 1 MiB chunks (constant memory) instead of going
+    through the sync supabase client, which blocks the event loop for
+    the whole transfer. Returns the public URL.
+    """
+    base_url, auth_header = _config()
+
+    ext = file_path.rsplit(".", 1)[-1].lower()
+    headers = {
+        **auth_header,
+        "Content-Type": _CONTENT_TYPES.get(ext, "application/octet-stream"),
+        "Content-Length": str(os.path.getsize(file_path)),
+        "x-upsert": "true",
+    }
+
+    client = get_async_client()
+    resp = await client.post(
+        f"{base_url}/storage/v1/object/{bucket}/{object_path}",
+        content=_file_chunks(file_path),
+        headers=headers,
+    )
+    resp.raise_for_status()
+
+    return f"{base_url}/storage/v1/object/public/{bucket}/{object_path}"
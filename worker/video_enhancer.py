@@ -1,15 +1,122 @@
+import asyncio
+import hashlib
+import json
 import subprocess
 import os
 import uuid
-from pathlib import Path
 import tempfile
+import aiofiles
+import numpy as np
 import replicate
-import requests
 from supabase import create_client
-import random
+
+# librosa is only needed for tempo analysis; without it music selection
+# falls back to random choice
+try:
+    import librosa
+except ImportError:
+    librosa = None
+
+from worker import storage
+from worker.http_client import get_async_client
+from worker.limits import replicate_semaphore, replicate_limiter, call_with_retries
+
+# Precomputed spectral features per library track (tempo in BPM),
+# generated offline and bundled with the worker
+_MUSIC_INDEX_PATH = os.path.join(os.path.dirname(__file__), "music_index.json")
+
+_AUDIO_SAMPLE_RATE = 22050
+
+# Content-addressed results of the heavy filter pass, keyed by input
+# hash + stage params; repeat uploads of the same clip skip the encode
+_STAGE_CACHE_BUCKET = "stage_cache"
+
+
+async def _run_ffmpeg(cmd: list) -> bytes:
+    """Run an ffmpeg command without blocking the event loop.
+
+    subprocess.run inside async methods stalled every other coroutine
+    for the duration of the encode (minutes); this awaits the process
+    instead, raising CalledProcessError on failure like before.
+
+    Always runs with -y and -nostdin: outputs are job-scoped temp paths,
+    and a fallback re-encode must be able to overwrite a partial file
+    left by the attempt that failed rather than dying on the
+    "Not overwriting" prompt.
+    """
+    if cmd[0] == 'ffmpeg':
+        cmd = ['ffmpeg', '-y', '-nostdin', *cmd[1:]]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    return stdout
 
 
 class VideoEnhancer:
+    # Hardware encoders in preference order, with their tuned arguments
+    _HW_ENCODERS = [
+        ('h264_nvenc', ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'hq',
+                        '-rc', 'vbr', '-cq', '23']),
+        ('h264_videotoolbox', ['-c:v', 'h264_videotoolbox', '-q:v', '60']),
+        ('h264_qsv', ['-c:v', 'h264_qsv', '-preset', 'medium', '-global_quality', '23']),
+    ]
+    _SW_ENCODER = ['-c:v', 'libx264', '-preset', 'medium']
+
+    # Cached across instances; probed once per process
+    _encoder_args = None
+    _has_vidstab = None
+
+    @classmethod
+    def _detect_encoder(cls) -> list:
+        """Pick a hardware H.264 encoder if this ffmpeg build has one."""
+        if cls._encoder_args is None:
+            try:
+                out = subprocess.run(
+                    ['ffmpeg', '-hide_banner', '-encoders'],
+                    capture_output=True, text=True
+                ).stdout
+            except OSError:
+                out = ''
+            cls._encoder_args = next(
+                (args for name, args in cls._HW_ENCODERS if name in out),
+                cls._SW_ENCODER
+            )
+        return cls._encoder_args
+
+    @classmethod
+    def _detect_vidstab(cls) -> bool:
+        """True when this ffmpeg build ships the vid.stab filters."""
+        if cls._has_vidstab is None:
+            try:
+                out = subprocess.run(
+                    ['ffmpeg', '-hide_banner', '-filters'],
+                    capture_output=True, text=True
+                ).stdout
+            except OSError:
+                out = ''
+            cls._has_vidstab = 'vidstabdetect' in out
+        return cls._has_vidstab
+
+    @classmethod
+    def _hwaccel_args(cls, on_gpu_filters: bool = False) -> list:
+        """Decode-side acceleration flags, paired with the NVENC encoder.
+
+        With on_gpu_filters the decoded frames stay in VRAM
+        (-hwaccel_output_format cuda) for CUDA filters; otherwise frames
+        are downloaded once for the CPU filter chain but decode itself
+        still runs on the GPU.
+        """
+        if cls._detect_encoder()[1] != 'h264_nvenc':
+            return []
+        if on_gpu_filters:
+            return ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+        return ['-hwaccel', 'cuda']
+
     def __init__(self):
 
         # Worker loads environment variables directly from Railway
@@ -21,145 +128,547 @@ class VideoEnhancer:
 
         self.supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
-        self.music_library = [
-            "https://example.com/music/upbeat1.mp3",
-            "https://example.com/music/chill1.mp3",
-            "https://example.com/music/energetic1.mp3"
-        ]
+        with open(_MUSIC_INDEX_PATH) as f:
+            index = json.load(f)
+        self.music_library = list(index)
+        # Parallel arrays so matching is one vectorized argmin, and a
+        # reusable Generator for the fallback draw — both precomputed
+        # here so nothing is rebuilt on the per-job hot path
+        self._music_urls = np.array(self.music_library)
+        self._music_tempos = np.array(
+            [index[url]["tempo"] for url in self.music_library]
+        )
+        self._rng = np.random.default_rng()
+        # One ffprobe per file; stages share the cached metadata
+        self._probe_cache = {}
     
     async def enhance_video(self, video_path: str, user_id: str) -> dict:
         """Complete video enhancement pipeline"""
-        temp_dir = tempfile.gettempdir()
         output_id = str(uuid.uuid4())
-        
-        # Step 1: Stabilization
-        stabilized = os.path.join(temp_dir, f"{output_id}_stabilized.mp4")
-        await self.stabilize_video(video_path, stabilized)
-        
-        # Step 2: Color Grading
-        graded = os.path.join(temp_dir, f"{output_id}_graded.mp4")
-        await self.apply_color_grade(stabilized, graded)
-        
-        # Step 3: Upscale (Replicate)
-        upscaled = os.path.join(temp_dir, f"{output_id}_upscaled.mp4")
-        await self.upscale_video(graded, upscaled)
-        
-        # Step 4: Add Transitions
-        final = os.path.join(temp_dir, f"{output_id}_final.mp4")
-        await self.add_transitions(upscaled, final)
-        
-        # Step 5: Reframe to Mobile (9:16)
-        mobile = os.path.join(temp_dir, f"{output_id}_mobile.mp4")
-        await self.reframe_to_mobile(final, mobile)
-        
-        # Step 6: Thumbnail
-        thumbnail = os.path.join(temp_dir, f"{output_id}_thumb.jpg")
-        await self.generate_thumbnail(mobile, thumbnail)
-        
-        # Step 7: Music selection
-        music_url = await self.select_music(mobile)
-        
-        # Step 8: Upload
-        media_url = await self.upload_to_storage(mobile, user_id, bucket="processed_media")
-        thumbnail_url = await self.upload_to_storage(thumbnail, user_id, bucket="thumbnails")
-        
-        # Cleanup temp files
-        for file in [stabilized, graded, upscaled, final, mobile, thumbnail]:
-            if os.path.exists(file):
-                os.remove(file)
-        
+
+        # Everything intermediate lives in one TemporaryDirectory, so a
+        # crash mid-pipeline can no longer leave multi-GB orphans in the
+        # temp filesystem
+        with tempfile.TemporaryDirectory(prefix=f"enh_{output_id}_") as temp_dir:
+            try:
+                # Step 1: Upscale (Replicate)
+                upscaled = os.path.join(temp_dir, "upscaled.mp4")
+                await self.upscale_video(video_path, upscaled)
+
+                # Steps 2-5: stabilize, grade, transitions, mobile reframe and
+                # thumbnail in a single fused ffmpeg pass (one decode, one encode)
+                mobile = os.path.join(temp_dir, "mobile.mp4")
+                thumbnail = os.path.join(temp_dir, "thumb.jpg")
+                stage_key = await asyncio.to_thread(
+                    self._content_key, upscaled, "fused_enhance",
+                    "".join(self._detect_encoder())
+                )
+                if not await self._cache_get(stage_key, mobile, thumbnail):
+                    try:
+                        await self.fused_enhance(upscaled, mobile, thumbnail)
+                    except subprocess.CalledProcessError:
+                        # Per-stage fallback for ffmpeg builds without the fused graph
+                        graded = os.path.join(temp_dir, "graded.mp4")
+                        final = os.path.join(temp_dir, "final.mp4")
+                        video_only = os.path.join(temp_dir, "mobile_video.mp4")
+                        await self.stabilize_and_grade(upscaled, graded)
+                        await self.add_transitions(graded, final)
+                        await self.reframe_to_mobile(final, video_only)
+                        # Intermediates run with -an; splice audio back in once
+                        await self._mux_audio(video_only, upscaled, mobile)
+                        await self.generate_thumbnail(mobile, thumbnail)
+                    await self._cache_put(stage_key, mobile, thumbnail)
+
+                # Steps 6-7: music analysis and both uploads are independent of
+                # each other, so they run concurrently
+                music_url, media_url, thumbnail_url = await asyncio.gather(
+                    self.select_music(mobile),
+                    self.upload_to_storage(mobile, f"{user_id}/{output_id}_media.mp4",
+                                           bucket="processed_media"),
+                    self.upload_to_storage(thumbnail, f"{user_id}/{output_id}_thumb.jpg",
+                                           bucket="thumbnails"),
+                )
+            finally:
+                # The enhancer is a process-lifetime singleton but the
+                # probe cache is keyed by this job's paths, which never
+                # repeat — drop them with the temp dir
+                for path in [p for p in self._probe_cache
+                             if p.startswith(temp_dir) or p == video_path]:
+                    self._probe_cache.pop(path, None)
+
         return {
             "media_url": media_url,
             "thumbnail_url": thumbnail_url,
             "music_url": music_url,
             "ai_style": "cinematic"
         }
+
+    def _content_key(self, input_path: str, stage: str, params: str) -> str:
+        """blake2b over file content + stage name + stage parameters."""
+        digest = hashlib.blake2b(digest_size=20)
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(stage.encode())
+        digest.update(params.encode())
+        return digest.hexdigest()
+
+    async def _cache_get(self, stage_key: str, media_path: str,
+                         thumbnail_path: str) -> bool:
+        """Restore cached stage outputs; False on any miss or error.
+
+        Streams each object to disk through the shared client in 1 MiB
+        chunks — a cached render is a full video, and the sync supabase
+        download would hold all of it in memory.
+        """
+        bucket = self.supabase.storage.from_(_STAGE_CACHE_BUCKET)
+        client = get_async_client()
+        try:
+            for key, path in ((f"{stage_key}/media.mp4", media_path),
+                              (f"{stage_key}/thumb.jpg", thumbnail_path)):
+                signed = await asyncio.to_thread(
+                    bucket.create_signed_url, key, 600
+                )
+                async with client.stream("GET", signed["signedURL"]) as resp:
+                    resp.raise_for_status()
+                    async with aiofiles.open(path, 'wb') as f:
+                        async for chunk in resp.aiter_bytes(1 << 20):
+                            await f.write(chunk)
+            return True
+        except Exception:
+            # A partial restore must not leave files behind: the caller
+            # re-renders to these exact paths on a miss
+            for path in (media_path, thumbnail_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return False
+
+    async def _cache_put(self, stage_key: str, media_path: str,
+                         thumbnail_path: str):
+        """Best-effort upload of stage outputs to the cache bucket."""
+        try:
+            await asyncio.gather(
+                storage.upload(media_path, f"{stage_key}/media.mp4",
+                               _STAGE_CACHE_BUCKET),
+                storage.upload(thumbnail_path, f"{stage_key}/thumb.jpg",
+                               _STAGE_CACHE_BUCKET),
+            )
+        except Exception:
+            pass
+
+    async def fused_enhance(self, input_path: str, output_path: str, thumbnail_path: str):
+        """Run the whole local filter chain as one ffmpeg invocation.
+
+        Chains stabilization, color grade, fades and the 9:16 reframe in
+        a single filter_complex graph with a split branch for the
+        thumbnail, so the video is decoded and encoded exactly once
+        instead of once per stage.
+
+        Stabilization prefers the two-pass vid.stab filters (better
+        quality, and the analysis pass decodes without encoding); the
+        per-frame deshake filter is the fallback on builds without them.
+        """
+        if self._detect_vidstab():
+            transforms = os.path.join(
+                os.path.dirname(output_path) or ".", "transforms.trf"
+            )
+            await _run_ffmpeg([
+                'ffmpeg', *self._hwaccel_args(), '-i', input_path,
+                '-vf', f'vidstabdetect=shakiness=5:accuracy=15:result={transforms}',
+                '-f', 'null', '-'
+            ])
+            stabilize = f"vidstabtransform=input={transforms}:smoothing=30"
+        else:
+            stabilize = "deshake"
+
+        filter_graph = (
+            f"[0:v]{stabilize},"
+            "curves=vintage,eq=contrast=1.2:brightness=0.05:saturation=1.3,"
+            "fade=in:0:30,fade=out:st=8:d=1,"
+            "scale=1080:1920:force_original_aspect_ratio=increase,crop=1080:1920,"
+            "split=2[main][thumb];"
+            "[thumb]select=eq(n\\,25)[th]"
+        )
+        cmd = [
+            'ffmpeg', *self._hwaccel_args(), '-i', input_path,
+            '-filter_complex', filter_graph,
+            '-map', '[main]',
+            *self._detect_encoder(),
+            '-map', '0:a?', '-c:a', 'copy',
+            output_path,
+            '-map', '[th]', '-frames:v', '1',
+            thumbnail_path
+        ]
+        await _run_ffmpeg(cmd)
     
+    async def _probe(self, video_path: str) -> dict:
+        """Stream metadata via one cached ffprobe — header read, no decode.
+
+        Every stage that starts with `-i file` repeats the same container
+        probe; reading it once per path and sharing the result drops the
+        redundant fork+probe cycles.
+        """
+        cached = self._probe_cache.get(video_path)
+        if cached is not None:
+            return cached
+
+        proc = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height,avg_frame_rate',
+            '-show_entries', 'format=duration', '-of', 'json',
+            video_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(
+                proc.returncode, 'ffprobe', stdout, stderr)
+
+        data = json.loads(stdout)
+        stream = data['streams'][0]
+        num, _, den = stream.get('avg_frame_rate', '0/1').partition('/')
+        fps = float(num) / float(den) if float(den or 0) else 0.0
+        probe = {
+            'w': int(stream['width']),
+            'h': int(stream['height']),
+            'fps': fps,
+            'duration': float(data['format'].get('duration', 0.0)),
+        }
+        self._probe_cache[video_path] = probe
+        return probe
+
+    async def _mux_audio(self, video_path: str, audio_source: str, output_path: str):
+        """Re-attach the source audio track with a copy-codec mux."""
+        await _run_ffmpeg([
+            'ffmpeg', '-i', video_path, '-i', audio_source,
+            '-map', '0:v', '-map', '1:a?',
+            '-c', 'copy',
+            output_path
+        ])
+
+    async def stabilize_and_grade(self, input_path: str, output_path: str):
+        """Pipe deshake output straight into the grading encode.
+
+        The stabilized frames travel to the second ffmpeg as an
+        uncompressed nut stream over an OS pipe, so the hop between the
+        two stages costs neither an encode pass nor a file write.
+        """
+        read_fd, write_fd = os.pipe()
+        try:
+            producer = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-nostdin', *self._hwaccel_args(), '-i', input_path,
+                '-vf', 'deshake',
+                '-c:v', 'rawvideo', '-an', '-f', 'nut', 'pipe:1',
+                stdout=write_fd,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            # no -nostdin here: the consumer's input *is* stdin
+            consumer = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-f', 'nut', '-i', 'pipe:0',
+                '-vf', 'curves=vintage,eq=contrast=1.2:brightness=0.05:saturation=1.3',
+                *self._detect_encoder(),
+                '-an',
+                output_path,
+                stdin=read_fd,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        finally:
+            # The children own duplicated fds now
+            os.close(read_fd)
+            os.close(write_fd)
+
+        (_, producer_err), (_, consumer_err) = await asyncio.gather(
+            producer.communicate(), consumer.communicate()
+        )
+        if producer.returncode:
+            raise subprocess.CalledProcessError(
+                producer.returncode, 'ffmpeg deshake', stderr=producer_err)
+        if consumer.returncode:
+            raise subprocess.CalledProcessError(
+                consumer.returncode, 'ffmpeg grade', stderr=consumer_err)
+
     async def stabilize_video(self, input_path: str, output_path: str):
         cmd = [
-            'ffmpeg', '-i', input_path,
+            'ffmpeg', *self._hwaccel_args(), '-i', input_path,
             '-vf', 'deshake',
-            '-c:v', 'libx264', '-preset', 'medium',
-            '-c:a', 'copy',
+            *self._detect_encoder(),
+            '-an',
             output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True)
+        await _run_ffmpeg(cmd)
     
     async def apply_color_grade(self, input_path: str, output_path: str):
         lut_filter = "curves=vintage"
         
         cmd = [
-            'ffmpeg', '-i', input_path,
+            'ffmpeg', *self._hwaccel_args(), '-i', input_path,
             '-vf', f'{lut_filter},eq=contrast=1.2:brightness=0.05:saturation=1.3',
-            '-c:v', 'libx264', '-preset', 'medium',
-            '-c:a', 'copy',
+            *self._detect_encoder(),
+            '-an',
             output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True)
+        await _run_ffmpeg(cmd)
     
     async def upscale_video(self, input_path: str, output_path: str):
         try:
-            with open(input_path, 'rb') as f:
-                output = replicate.run(
-                    "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b",
-                    input={
-                        "image": f,
-                        "scale": 2,
-                        "face_enhance": True
-                    }
-                )
-            
-            res = requests.get(output)
-            with open(output_path, 'wb') as f:
-                f.write(res.content)
-        
+            # Frames are independent, so the clip is split into
+            # copy-codec segments that upscale as parallel Replicate
+            # calls (bounded by the replicate semaphore) and re-join
+            # with a copy-codec concat
+            with tempfile.TemporaryDirectory(prefix="upscale_") as chunk_dir:
+                # Clips shorter than one segment can never split; the
+                # cached probe answers that without spawning the segmenter
+                probe = await self._probe(input_path)
+                if 0 < probe['duration'] <= 10:
+                    chunks = [input_path]
+                else:
+                    chunks = await self._split_video(input_path, chunk_dir)
+                if len(chunks) <= 1:
+                    await self._upscale_chunk(input_path, output_path)
+                else:
+                    upscaled_chunks = [f"{c}.up.mp4" for c in chunks]
+                    await asyncio.gather(*[
+                        self._upscale_chunk(c, out)
+                        for c, out in zip(chunks, upscaled_chunks)
+                    ])
+                    await self._concat_chunks(upscaled_chunks, chunk_dir, output_path)
+
         except Exception:
-            # fallback upscale
-            cmd = [
-                'ffmpeg', '-i', input_path,
-                '-vf', 'scale=1080:1920:flags=lanczos',
-                '-c:v', 'libx264', '-preset', 'medium',
-                output_path
-            ]
-            subprocess.run(cmd, check=True, capture_output=True)
-    
+            # fallback upscale; pure scaling, so on NVENC hosts frames can
+            # stay in VRAM from decode through encode
+            if self._detect_encoder()[1] == 'h264_nvenc':
+                cmd = [
+                    'ffmpeg', *self._hwaccel_args(on_gpu_filters=True),
+                    '-i', input_path,
+                    '-vf', 'scale_cuda=1080:1920:interp_algo=lanczos',
+                    *self._detect_encoder(),
+                    output_path
+                ]
+            else:
+                cmd = [
+                    'ffmpeg', '-i', input_path,
+                    '-vf', 'scale=1080:1920:flags=lanczos',
+                    *self._detect_encoder(),
+                    output_path
+                ]
+            await _run_ffmpeg(cmd)
+
+    async def _upscale_chunk(self, input_path: str, output_path: str):
+        """Upscale one file through Replicate and stream the result back."""
+        # Hand Replicate a signed URL so it pulls the file from
+        # Supabase's CDN itself instead of the worker streaming the
+        # whole body to Replicate's upload endpoint first
+        try:
+            source = await self._signed_input_url(input_path)
+        except Exception:
+            source = input_path
+
+        async with replicate_semaphore, replicate_limiter:
+            output = await call_with_retries(
+                asyncio.to_thread, self._replicate_upscale, source
+            )
+
+        # Stream straight from socket to file in 1 MiB chunks; the
+        # upscaled result can be hundreds of MB. Written under a .part
+        # name and renamed on success, so a mid-download failure never
+        # leaves a partial file at output_path for the fallback encode
+        # to trip over.
+        part_path = output_path + '.part'
+        client = get_async_client()
+        async with client.stream("GET", str(output)) as resp:
+            resp.raise_for_status()
+            async with aiofiles.open(part_path, 'wb') as f:
+                async for chunk in resp.aiter_bytes(1 << 20):
+                    await f.write(chunk)
+        os.replace(part_path, output_path)
+
+    async def _split_video(self, input_path: str, chunk_dir: str,
+                           segment_seconds: int = 10) -> list:
+        """Split into keyframe-aligned segments without re-encoding."""
+        pattern = os.path.join(chunk_dir, "chunk_%03d.mp4")
+        await _run_ffmpeg([
+            'ffmpeg', '-i', input_path,
+            '-c', 'copy', '-map', '0',
+            '-f', 'segment', '-segment_time', str(segment_seconds),
+            '-reset_timestamps', '1',
+            pattern
+        ])
+        return sorted(
+            os.path.join(chunk_dir, name)
+            for name in os.listdir(chunk_dir)
+            if name.startswith("chunk_")
+        )
+
+    async def _concat_chunks(self, chunk_paths: list, chunk_dir: str,
+                             output_path: str):
+        list_path = os.path.join(chunk_dir, "concat.txt")
+        with open(list_path, 'w') as f:
+            for path in chunk_paths:
+                f.write(f"file '{path}'\n")
+        await _run_ffmpeg([
+            'ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-c', 'copy', output_path
+        ])
+
+    async def _signed_input_url(self, input_path: str, expires_in: int = 3600) -> str:
+        """Stage the input in the tmp bucket and sign a URL for Replicate."""
+        key = f"replicate/{uuid.uuid4()}.mp4"
+        await storage.upload(input_path, key, "tmp")
+        signed = await asyncio.to_thread(
+            self.supabase.storage.from_("tmp").create_signed_url, key, expires_in
+        )
+        return signed["signedURL"]
+
+    def _replicate_upscale(self, source) -> str:
+        """Run Real-ESRGAN on a signed URL, or a file handle as fallback."""
+        if isinstance(source, str) and source.startswith("http"):
+            return replicate.run(
+                "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b",
+                input={
+                    "image": source,
+                    "scale": 2,
+                    "face_enhance": True
+                }
+            )
+        with open(source, 'rb') as f:
+            return replicate.run(
+                "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b",
+                input={
+                    "image": f,
+                    "scale": 2,
+                    "face_enhance": True
+                }
+            )
+
     async def add_transitions(self, input_path: str, output_path: str):
         cmd = [
-            'ffmpeg', '-i', input_path,
+            'ffmpeg', *self._hwaccel_args(), '-i', input_path,
             '-vf', 'fade=in:0:30,fade=out:st=8:d=1',
-            '-c:v', 'libx264', '-preset', 'medium',
-            '-c:a', 'copy',
+            *self._detect_encoder(),
+            '-an',
             output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True)
+        await _run_ffmpeg(cmd)
     
     async def reframe_to_mobile(self, input_path: str, output_path: str):
+        # Already-mobile sources need no reframe: stream-copy instead of
+        # paying a full decode+encode for a no-op scale/crop
+        try:
+            probe = await self._probe(input_path)
+            width, height = probe['w'], probe['h']
+        except (subprocess.CalledProcessError, ValueError, KeyError, OSError):
+            width = height = None
+        if (width, height) == (1080, 1920):
+            await _run_ffmpeg([
+                'ffmpeg', '-i', input_path, '-c', 'copy', '-an', output_path
+            ])
+            return
+
+        vf = 'scale=1080:1920:force_original_aspect_ratio=increase,crop=1080:1920'
+
+        # x264's frame parallelism plateaus around 8 threads; on
+        # many-core hosts without a hardware encoder, parallel segment
+        # encodes saturate the remaining cores
+        if self._detect_encoder() is self._SW_ENCODER:
+            try:
+                await self._segmented_encode(input_path, vf, output_path)
+                return
+            except subprocess.CalledProcessError:
+                pass
+
         cmd = [
-            'ffmpeg', '-i', input_path,
-            '-vf', 'scale=1080:1920:force_original_aspect_ratio=increase,crop=1080:1920',
-            '-c:v', 'libx264', '-preset', 'medium',
-            '-c:a', 'copy',
+            'ffmpeg', *self._hwaccel_args(), '-i', input_path,
+            '-vf', vf,
+            *self._detect_encoder(),
+            '-an',
             output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True)
+        await _run_ffmpeg(cmd)
+
+    async def _segmented_encode(self, input_path: str, vf: str, output_path: str,
+                                segment_seconds: int = 10):
+        """Split, encode segments concurrently, concat with stream copy.
+
+        Each segment encodes with -threads 2; concurrency is capped at
+        the core count, so total CPU use scales with the host instead of
+        x264's internal thread ceiling.
+        """
+        with tempfile.TemporaryDirectory(prefix="segenc_") as seg_dir:
+            pattern = os.path.join(seg_dir, "seg_%03d.ts")
+            await _run_ffmpeg([
+                'ffmpeg', '-i', input_path,
+                '-c', 'copy', '-an',
+                '-f', 'segment', '-segment_time', str(segment_seconds),
+                '-reset_timestamps', '1',
+                pattern
+            ])
+            segments = sorted(
+                os.path.join(seg_dir, name)
+                for name in os.listdir(seg_dir)
+                if name.startswith("seg_")
+            )
+            if len(segments) <= 1:
+                raise subprocess.CalledProcessError(1, 'segment', b'', b'single segment')
+
+            encode_slots = asyncio.Semaphore(os.cpu_count() or 4)
+
+            async def encode(segment: str, encoded: str):
+                async with encode_slots:
+                    await _run_ffmpeg([
+                        'ffmpeg', '-i', segment,
+                        '-vf', vf,
+                        *self._SW_ENCODER, '-threads', '2',
+                        '-an', '-f', 'mpegts',
+                        encoded
+                    ])
+
+            encoded_segments = [f"{s}.enc.ts" for s in segments]
+            await asyncio.gather(*[
+                encode(s, e) for s, e in zip(segments, encoded_segments)
+            ])
+            await self._concat_chunks(encoded_segments, seg_dir, output_path)
     
     async def generate_thumbnail(self, video_path: str, output_path: str):
+        # -ss before -i seeks on the input by keyframe (near-instant)
+        # instead of decoding every frame up to the 1s mark; no scale
+        # needed since the mobile render is already 1080x1920
         cmd = [
-            'ffmpeg', '-i', video_path,
-            '-ss', '00:00:01',
-            '-vframes', '1',
-            '-vf', 'scale=1080:1920',
+            'ffmpeg', '-ss', '00:00:01', '-i', video_path,
+            '-frames:v', '1', '-q:v', '2',
             output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True)
+        await _run_ffmpeg(cmd)
     
     async def select_music(self, video_path: str) -> str:
-        return random.choice(self.music_library)
+        """Match the video's audio tempo against the precomputed library
+        index; random choice when analysis is unavailable or fails."""
+        if librosa is None:
+            return str(self._rng.choice(self._music_urls))
+        try:
+            tempo = await asyncio.to_thread(self._estimate_tempo, video_path)
+        except Exception:
+            return str(self._rng.choice(self._music_urls))
+        return str(self._music_urls[int(np.argmin(np.abs(self._music_tempos - tempo)))])
+
+    def _estimate_tempo(self, video_path: str) -> float:
+        """Decode the audio track once via ffmpeg and beat-track it."""
+        cmd = [
+            'ffmpeg', '-i', video_path,
+            '-vn', '-ac', '1', '-ar', str(_AUDIO_SAMPLE_RATE),
+            '-f', 's16le', 'pipe:1'
+        ]
+        raw = subprocess.run(cmd, check=True, capture_output=True).stdout
+        samples = np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0
+        if samples.size == 0:
+            raise ValueError("no audio track")
+        tempo, _ = librosa.beat.beat_track(y=samples, sr=_AUDIO_SAMPLE_RATE)
+        return float(np.atleast_1d(tempo)[0])
     
-    async def upload_to_storage(self, file_path: str, user_id: str, bucket: str) -> str:
-        filename = f"{user_id}/{uuid.uuid4()}.{Path(file_path).suffix[1:]}"
-        
-        with open(file_path, 'rb') as f:
-            self.supabase.storage.from_(bucket).upload(filename, f)
+    async def upload_to_storage(self, file_path: str, object_path: str, bucket: str) -> str:
+        """Upload under a caller-chosen object path.
 
-        return self.supabase.storage.from_(bucket).get_public_url(filename)
+        The caller already knows the job id and extension, so no uuid or
+        Path parsing is needed on the per-upload hot path.
+        """
+        return await storage.upload(file_path, object_path, bucket)